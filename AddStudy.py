@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import os
-import subprocess
 import sys
 import pydicom
 import shutil
@@ -9,6 +8,10 @@ import multiprocessing
 import argparse
 import pandas as pd
 from dicom_sorting_tool import sort_dicom
+from datetime import datetime
+from pixel_verification import VerificationReport, pixel_digest, save_with_pixel_digest
+from tool_runner import Job, run_job, new_log_dir
+from dicom_archive_reader import is_archive, submit_archive_members, archive_parent, member_as_file, write_member
 
 
 """
@@ -16,6 +19,7 @@ DICOM Processing Script
 
 This script processes individual DICOM files for medical imaging research. It supports anonymization,
 sorting, and conversion to BIDS format. The script prompts for subject and session IDs instead of reading from a TSV file.
+Zip and tar(.gz) archives placed in the Inbox are read directly, without extracting them first.
 
 Usage:
     python AddStudy.py
@@ -53,14 +57,26 @@ def parse_arguments():
         action='store_true',
         help='Skip populating participants.tsv file.'
     )
+    parser.add_argument(
+        '--noverify',
+        action='store_true',
+        help='Skip hashing pixel data during anonymization (no verification report).'
+    )
+    parser.add_argument(
+        '--packsourcedata',
+        action='store_true',
+        help='Store each series in sourcedata as a single pack with an offset index (see dicom_series_pack.py).'
+    )
     return parser.parse_args()
 
 
 
 
-def anonymize_dicom_file(input_file, output_file, patient_id):
+def anonymize_dicom_file(input_file, output_file, patient_id, report=None):
     try:
         ds = pydicom.dcmread(input_file, force=True)
+        # Hash the pixel data as read, before any tag is touched
+        source_digest = pixel_digest(ds) if report is not None else None
         tags_to_anonymize = {
             (0x0010, 0x0010): patient_id,  # Patient's Name
             (0x0010, 0x0020): patient_id,  # Patient ID
@@ -74,16 +90,30 @@ def anonymize_dicom_file(input_file, output_file, patient_id):
             if tag in ds:
                 ds[tag].value = value
 
-        ds.save_as(output_file)
+        if report is None:
+            ds.save_as(output_file)
+        else:
+            written_digest = save_with_pixel_digest(ds, output_file)
+            report.add(getattr(input_file, 'name', input_file), output_file, source_digest, written_digest)
+        return True
     except Exception as e:
         print(f"Error processing {input_file}: {e}")
+    return False
 
 def anonymize_wrapper(args):
-    src_file, dest_file, patient_id = args
-    shutil.copy(src_file, dest_file)
-    anonymize_dicom_file(dest_file, dest_file, patient_id)
-
-def process_directory(input_dir, output_dir, patient_id):
+    src_file, dest_file, patient_id, report = args
+    # The source is read once and the anonymized file written straight to dest_file;
+    # files that cannot be anonymized are copied over unchanged
+    if not anonymize_dicom_file(src_file, dest_file, patient_id, report):
+        shutil.copy(src_file, dest_file)
+
+def anonymize_member(archive_path, member_name, mtime, data, dest_file, patient_id, report=None):
+    # Same result as extracting the member and running anonymize_wrapper on it
+    os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+    if not anonymize_dicom_file(member_as_file(archive_path, member_name, data), dest_file, patient_id, report):
+        write_member(dest_file, data)
+
+def process_directory(input_dir, output_dir, patient_id, report=None):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
@@ -95,10 +125,18 @@ def process_directory(input_dir, output_dir, patient_id):
         for root, dirs, files in os.walk(input_dir):
             for file in files:
                 src_file = os.path.join(root, file)
+                if is_archive(file):
+                    # Members land where they would if the archive were extracted next to itself
+                    dest_root = os.path.join(output_dir, archive_parent(src_file, input_dir))
+                    tasks.extend(submit_archive_members(
+                        executor, src_file,
+                        lambda archive, name, mtime, data, dest_root=dest_root: anonymize_member(
+                            archive, name, mtime, data, os.path.normpath(os.path.join(dest_root, name)), patient_id, report)))
+                    continue
                 rel_path = os.path.relpath(src_file, input_dir)
                 dest_file = os.path.join(output_dir, rel_path)
                 os.makedirs(os.path.dirname(dest_file), exist_ok=True)
-                args = (src_file, dest_file, patient_id)
+                args = (src_file, dest_file, patient_id, report)
                 tasks.append(executor.submit(anonymize_wrapper, args))
 
         for future in tasks:
@@ -149,18 +187,24 @@ def main():
 
     if not args.noanon:
         print("Processing directories for anonymization.")
-        process_directory(raw_dicom_folder, anon_dicom_folder, subject)
+        report = None if args.noverify else VerificationReport()
+        process_directory(raw_dicom_folder, anon_dicom_folder, subject, report)
+        if report is not None:
+            report_name = f"anonymization_verification_{datetime.now():%Y%m%d_%H%M%S}.tsv"
+            report.write(os.path.join(bidsdir_folder, "code", report_name))
 
 
     if not args.nosort:
         print("Sorting DICOM files.")
-        sort_dicom(anon_dicom_folder, sourcedata_dir)
+        sort_dicom(anon_dicom_folder, sourcedata_dir, pack=args.packsourcedata)
 
 
     if not args.nobids:
         print("Running dcm2bids for NIfTI conversion.")
         dcm2bids_cmd = ["dcm2bids", "-d", anon_dicom_folder, "-p", subject, "-s", session, "-c", dcm2bids_config, "-o", bidsdir_folder]
-        subprocess.run(dcm2bids_cmd)
+        log_dir = new_log_dir(os.path.join(bidsdir_folder, "code", "logs"))
+        result = run_job(Job(f"dcm2bids_{subject}_{session}", dcm2bids_cmd), log_dir)
+        print(f"dcm2bids finished with exit code {result.returncode} in {result.wall_time:.1f} s. Log: {result.log_file}")
 
     if not args.nocleanup:
         shutil.rmtree(anon_dicom_folder)
@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import os
-import subprocess
 import sys
 import pydicom
 import shutil
@@ -10,6 +9,16 @@ import pandas as pd
 from datetime import datetime, timedelta
 import argparse
 import glob
+import tempfile
+from functools import partial
+from dicom_series_pack import has_packs, extract_session
+from subject_mapping import load_subject_mapping
+from pixel_verification import VerificationReport, pixel_digest, save_with_pixel_digest
+from run_report import RunReport, timed
+from tool_runner import Job, run_job, run_job_groups, new_log_dir, default_workers
+from batch_sharding import parse_shard, in_shard, shard_key, shard_suffix, bids_lock_path, file_lock
+from dicom_archive_reader import (is_archive, iter_archive_members, submit_archive_members,
+                                  archive_parent, member_as_file, write_member)
 
 """
 DICOM Processing Script
@@ -21,12 +30,21 @@ command line flags.
 Usage:
     python script_name.py [options]
 
+Zip and tar(.gz) archives placed in the Inbox are read directly, without extracting them first.
+
 Options:
     --noanon          Skip the anonymization step.
     --nosort          Skip the sorting step.
     --nobids          Skip the conversion to BIDS format.
     --nocleanup       Skip cleanup of temporary unsorted anonymized dicom dir.
     --noparticipants  Skip populating participants.tsv file.
+    --packsourcedata  Store each sourcedata series as a single pack file with an offset index.
+    --noverify        Skip hashing pixel data during anonymization (no verification report).
+    --jobs N          Number of dcm2bids conversions run in parallel (default: CPU count - 2).
+    --timeout S       Time limit in seconds for each dcm2bids conversion.
+    --retries N       Retry a failed dcm2bids conversion N times.
+    --profile         Profile the hot path with cProfile (saved next to the run report).
+    --shard i/N       Only process the patients of shard i out of N (for parallel runs on several machines).
 """
 
 
@@ -63,18 +81,62 @@ def parse_arguments():
         action='store_true',
         help='Skip populating participants.tsv file.'
     )
+    parser.add_argument(
+        '--packsourcedata',
+        action='store_true',
+        help='Store each series in sourcedata as a single pack with an offset index (see dicom_series_pack.py).'
+    )
+    parser.add_argument(
+        '--noverify',
+        action='store_true',
+        help='Skip hashing pixel data during anonymization (no verification report).'
+    )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=default_workers(),
+        help='Number of dcm2bids conversions run in parallel (default: CPU count - 2).'
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=None,
+        help='Time limit in seconds for each dcm2bids conversion (default: no limit).'
+    )
+    parser.add_argument(
+        '--retries',
+        type=int,
+        default=0,
+        help='Retry a failed or timed out dcm2bids conversion this many times.'
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Profile the participants, anonymization and sorting code with cProfile.\n'
+             'The statistics are saved next to the run report in BIDSDIR/code/logs/<date>_<time>.'
+    )
+    parser.add_argument(
+        '--shard',
+        type=parse_shard,
+        default=None,
+        metavar='i/N',
+        help='Only process patients of shard i out of N, partitioned by new subject ID (e.g. 1/4).\n'
+             'Runs with different shards can share the same Inbox and BIDSDIR.'
+    )
     return parser.parse_args()
 
 
 def read_subject_mapping(filename):
-    df = pd.read_csv(filename, sep=r'\s+', header=None, dtype=str)
-    # Map DICOM PatientID to new subject ID (e.g., '41411412222222': 'sub-001')
-    return {row[1]: 'sub-' + row[0].zfill(3) for _, row in df.iterrows()}
+    # Map DICOM PatientID to new subject ID (e.g., '41411412222222': 'sub-001').
+    # Backed by a compiled store next to the TSV that is only rebuilt when the TSV changes.
+    return load_subject_mapping(filename)
 
 
-def anonymize_dicom_file(input_file, output_file, patient_id_map):
+def anonymize_dicom_file(input_file, output_file, patient_id_map, report=None):
     try:
         ds = pydicom.dcmread(input_file, force=True)
+        # Hash the pixel data as read, before any tag is touched
+        source_digest = pixel_digest(ds) if report is not None else None
         patient_id = ds.get((0x0010, 0x0020))
 
         if patient_id and patient_id.value in patient_id_map:
@@ -93,39 +155,88 @@ def anonymize_dicom_file(input_file, output_file, patient_id_map):
                 if tag in ds:
                     ds[tag].value = value
 
-            ds.save_as(output_file)
+            if report is None:
+                ds.save_as(output_file)
+            else:
+                written_digest = save_with_pixel_digest(ds, output_file)
+                report.add(getattr(input_file, 'name', input_file), output_file, source_digest, written_digest)
+            return True
         else:
             print(f"Patient ID {patient_id.value} not found in ID_correspondence.tsv. Skipping {input_file}")
 
     except Exception as e:
         print(f"Error processing {input_file}: {e}")
+    return False
+
+def read_patient_id(dicom_file):
+    """Read only the PatientID of a DICOM file (path or file object), '' if it cannot be read."""
+    try:
+        ds = pydicom.dcmread(dicom_file, stop_before_pixels=True, force=True, specific_tags=['PatientID'])
+        return str(ds.get('PatientID', ''))
+    except Exception:
+        return ''
 
 def anonymize_wrapper(args):
-    src_file, dest_file, patient_id_map = args
-    shutil.copy(src_file, dest_file)
-    anonymize_dicom_file(dest_file, dest_file, patient_id_map)
+    src_file, dest_file, patient_id_map, shard, report, stats = args
+    if shard is not None and not in_shard(shard_key(read_patient_id(src_file), patient_id_map), shard):
+        return
+    with timed(stats, src_file, os.path.getsize(src_file)) as sizes:
+        # The source is read once and the anonymized file written straight to dest_file;
+        # files that are not anonymized are copied over unchanged
+        if not anonymize_dicom_file(src_file, dest_file, patient_id_map, report):
+            shutil.copy(src_file, dest_file)
+        sizes['bytes_written'] = os.path.getsize(dest_file)
+
+def anonymize_member(archive_path, member_name, mtime, data, dest_file, patient_id_map, shard=None, report=None,
+                     stats=None):
+    # Same result as extracting the member and running anonymize_wrapper on it: files that are
+    # not anonymized are still copied over unchanged.
+    if shard is not None:
+        patient_id = read_patient_id(member_as_file(archive_path, member_name, data))
+        if not in_shard(shard_key(patient_id, patient_id_map), shard):
+            return
+    with timed(stats, f"{archive_path}:{member_name}", len(data)) as sizes:
+        os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+        if not anonymize_dicom_file(member_as_file(archive_path, member_name, data), dest_file, patient_id_map, report):
+            write_member(dest_file, data)
+        sizes['bytes_written'] = os.path.getsize(dest_file)
 
 def is_dicom_file(filename):
     """Check if a file is likely to be a DICOM file."""
     return filename.lower().endswith('.dcm') or '.' not in filename
 
-def process_directory(input_dir, output_dir, patient_id_map):
+def process_directory(input_dir, output_dir, patient_id_map, shard=None, report=None, stats=None):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
     num_cores = multiprocessing.cpu_count()
     max_threads = max(1, num_cores - 2)
+    if stats is not None:
+        stats.workers = max_threads
+        anonymize_file = stats.profiled(anonymize_wrapper)
+        anonymize_archive_member = stats.profiled(anonymize_member)
+    else:
+        anonymize_file, anonymize_archive_member = anonymize_wrapper, anonymize_member
 
     with ThreadPoolExecutor(max_workers=max_threads) as executor:
         tasks = []
         for root, dirs, files in os.walk(input_dir):
             for file in files:
                 src_file = os.path.join(root, file)
+                if is_archive(file):
+                    # Members land where they would if the archive were extracted next to itself
+                    dest_root = os.path.join(output_dir, archive_parent(src_file, input_dir))
+                    tasks.extend(submit_archive_members(
+                        executor, src_file,
+                        lambda archive, name, mtime, data, dest_root=dest_root: anonymize_archive_member(
+                            archive, name, mtime, data, os.path.normpath(os.path.join(dest_root, name)),
+                            patient_id_map, shard, report, stats)))
+                    continue
                 rel_path = os.path.relpath(src_file, input_dir)
                 dest_file = os.path.join(output_dir, rel_path)
                 os.makedirs(os.path.dirname(dest_file), exist_ok=True)
-                args = (src_file, dest_file, patient_id_map)
-                tasks.append(executor.submit(anonymize_wrapper, args))
+                args = (src_file, dest_file, patient_id_map, shard, report, stats)
+                tasks.append(executor.submit(anonymize_file, args))
 
         for future in tasks:
             future.result()
@@ -139,64 +250,156 @@ def get_new_session_number(subject_dir):
     else:
         return 'ses-01'
 
-def process_new_sessions(sourcedata_dir, bidsdir_folder, dcm2bids_config):
+def allocate_session_number(subject_dir, lock_path):
+    """
+    Pick the next session number and reserve it by creating its folder, while holding the BIDSDIR lock,
+    so concurrent runs never get the same session for one subject.
+    """
+    with file_lock(lock_path):
+        session = get_new_session_number(subject_dir)
+        os.makedirs(os.path.join(subject_dir, session))
+    return session
+
+def release_session_number(subject_dir, session):
+    """Give back a reserved session number if nothing was written to it (and the subject folder if it is left empty)."""
+    session_dir = os.path.join(subject_dir, session)
+    if os.path.isdir(session_dir) and not os.listdir(session_dir):
+        os.rmdir(session_dir)
+        if not os.listdir(subject_dir):
+            os.rmdir(subject_dir)
+
+def unpack_session(studydate_path, unpack_dir):
+    # dcm2bids needs one file per instance, so packed series are re-extracted first.
+    # A folder left behind by an interrupted run is replaced.
+    shutil.rmtree(unpack_dir, ignore_errors=True)
+    extract_session(studydate_path, unpack_dir)
+
+def subject_session_jobs(subject, studydate_paths, bidsdir_folder, dcm2bids_config, lock_path, timeout=None, retries=0):
+    """
+    dcm2bids jobs for the new study dates of one subject, to be run one after another. Each session number
+    is reserved right before its job runs and given back right after it if nothing was written (dcm2bids
+    also exits 0 when no series matches the config), so the next study date gets that number instead and
+    session numbers have no gaps.
+    """
+    subject_dir = os.path.join(bidsdir_folder, subject)
+    for studydate_path in studydate_paths:
+        session = allocate_session_number(subject_dir, lock_path)
+        try:
+            dicom_dir, setup, cleanup = studydate_path, None, None
+            if has_packs(studydate_path):
+                # Extracted by the job itself and removed when it ends, so only the sessions
+                # being converted take up extra disk space
+                dicom_dir = os.path.join(bidsdir_folder, f".temp_unpack_{subject}_{session}")
+                setup = partial(unpack_session, studydate_path, dicom_dir)
+                cleanup = partial(shutil.rmtree, dicom_dir, ignore_errors=True)
+            dcm2bids_cmd = [
+                "dcm2bids", "-d", dicom_dir, "-p", subject, 
+                "-s", session, "-c", dcm2bids_config, "-o", bidsdir_folder
+            ]
+            print("Running:", ' '.join(dcm2bids_cmd))  # Print the command for verification
+            # A failed attempt leaves its dcm2niix output in tmp_dcm2bids, which dcm2bids would
+            # otherwise reuse instead of converting again
+            retry_cmd = dcm2bids_cmd + ["--force_dcm2bids"]
+            # The study date keeps the log of a released session from being overwritten by the next one
+            name = f"dcm2bids_{subject}_{session}_{os.path.basename(studydate_path)}"
+            yield Job(name, dcm2bids_cmd, timeout, retries, retry_cmd, setup, cleanup)
+        finally:
+            release_session_number(subject_dir, session)
+
+def process_new_sessions(sourcedata_dir, bidsdir_folder, dcm2bids_config, shard=None,
+                         log_dir=None, max_workers=None, timeout=None, retries=0, stats=None):
     now = datetime.now()
     one_hour_ago = now - timedelta(hours=1)
+    lock_path = bids_lock_path(bidsdir_folder)
+    log_dir = log_dir or new_log_dir(os.path.join(bidsdir_folder, "code", "logs"))
+
+    # Subjects are converted in parallel, the new study dates of one subject in date order
+    groups, total = [], 0
 
     for subject in os.listdir(sourcedata_dir):
         subject_dir = os.path.join(sourcedata_dir, subject)
-        if os.path.isdir(subject_dir):
-            for studydate in os.listdir(subject_dir):
+        # Sorted folders are named after the new subject ID, which is also the shard key
+        if os.path.isdir(subject_dir) and in_shard(subject, shard):
+            studydate_paths = []
+            for studydate in sorted(os.listdir(subject_dir)):
                 studydate_path = os.path.join(subject_dir, studydate)
                 
                 # Get the modification time of the folder
                 folder_mod_time = datetime.fromtimestamp(os.path.getmtime(studydate_path))
 
                 if folder_mod_time > one_hour_ago:
-                    session = get_new_session_number(os.path.join(bidsdir_folder, subject))
-                    dcm2bids_cmd = [
-                        "dcm2bids", "-d", studydate_path, "-p", subject, 
-                        "-s", session, "-c", dcm2bids_config, "-o", bidsdir_folder
-                    ]
-                    print("Executing:", ' '.join(dcm2bids_cmd))  # Print the command for verification
-                    result = subprocess.run(dcm2bids_cmd, capture_output=True, text=True)
-                    print(result.stdout)  # Print standard output
-                    print(result.stderr, file=sys.stderr)  # Print standard error to stderr
-
-
-
-def populate_participants_tsv(inbox_folder, participant_map_file, bidsdir_folder):
+                    studydate_paths.append(studydate_path)
+            if studydate_paths:
+                groups.append(subject_session_jobs(subject, studydate_paths, bidsdir_folder, dcm2bids_config,
+                                                   lock_path, timeout, retries))
+                total += len(studydate_paths)
+
+    results = run_job_groups(groups, log_dir, max_workers, total)
+
+    for result in results:
+        if stats is not None:
+            stats.record(result.name, result.wall_time)
+        if result.returncode != 0:
+            print(f"dcm2bids failed for {result.name}, see {result.log_file}", file=sys.stderr)
+
+
+
+def read_participant_row(ds, participant_map):
+    original_patient_id = ds.PatientID if 'PatientID' in ds else "Unknown"
+    age = ds.PatientAge if 'PatientAge' in ds else ""
+    sex = ds.PatientSex if 'PatientSex' in ds else ""
+    new_patient_id = participant_map.get(original_patient_id, "Unknown")
+    return [new_patient_id, age, sex, "", "", original_patient_id]
+
+def first_dicom_per_folder_in_archive(archive_path):
+    """Read the first DICOM member of every folder inside an archive, as the Inbox walk does."""
+    seen_folders = set()
+    for member in iter_archive_members(archive_path):
+        folder = os.path.dirname(member.name)
+        if folder in seen_folders or not is_dicom_file(os.path.basename(member.name)):
+            continue
+        seen_folders.add(folder)
+        yield pydicom.dcmread(member_as_file(archive_path, member.name, member.read()))
+
+def populate_participants_tsv(inbox_folder, participant_map_file, bidsdir_folder, shard=None, stats=None):
     participant_map = read_subject_mapping(participant_map_file)
     participants_file = os.path.join(bidsdir_folder, "participants.tsv")
 
-    required_columns = ["participant_id", "age", "sex", "notes"]
-    should_append = file_has_required_columns(participants_file, required_columns)
-
-    if not should_append:
-        with open(participants_file, "w") as file:
-            file.write("participant_id\tage\tsex\tgroup\tnotes\toriginal_id\n")
-
     participants_data = {}  # Initialize the participants_data dictionary
 
-    with open(participants_file, "a" if should_append else "w") as file:
-        if not should_append:
-            file.write("participant_id\tage\tsex\tgroup\tnotes\toriginal_id\n")
-
-        for root, dirs, files in os.walk(inbox_folder):
-            for file_name in files:
-                if is_dicom_file(file_name):
-                    dicom_file = os.path.join(root, file_name)
+    for root, dirs, files in os.walk(inbox_folder):
+        for file_name in files:
+            if is_archive(file_name):
+                for ds in first_dicom_per_folder_in_archive(os.path.join(root, file_name)):
+                    row = read_participant_row(ds, participant_map)
+                    if in_shard(shard_key(row[5], participant_map), shard):
+                        participants_data.setdefault(row[0], row)
+
+        for file_name in files:
+            if is_dicom_file(file_name):
+                dicom_file = os.path.join(root, file_name)
+                with timed(stats, dicom_file, os.path.getsize(dicom_file)):
                     ds = pydicom.dcmread(dicom_file)
-                    original_patient_id = ds.PatientID if 'PatientID' in ds else "Unknown"
-                    age = ds.PatientAge if 'PatientAge' in ds else ""
-                    sex = ds.PatientSex if 'PatientSex' in ds else ""
-                    new_patient_id = participant_map.get(original_patient_id, "Unknown")
-                    if new_patient_id not in participants_data:
-                        participants_data[new_patient_id] = [new_patient_id, age, sex, "", "", original_patient_id]
-                    break  # Break after processing the first DICOM file in each folder
-
-        for data in participants_data.values():
-            file.write("\t".join(data) + "\n")
+                row = read_participant_row(ds, participant_map)
+                if in_shard(shard_key(row[5], participant_map), shard):
+                    participants_data.setdefault(row[0], row)
+                break  # Break after processing the first DICOM file in each folder
+
+    # Other runs may be writing participants.tsv at the same time: check and append under the lock,
+    # and never add a participant that is already listed
+    with file_lock(bids_lock_path(bidsdir_folder)):
+        required_columns = ["participant_id", "age", "sex", "notes"]
+        should_append = file_has_required_columns(participants_file, required_columns)
+        existing_ids = set()
+        if should_append:
+            existing_ids = set(pd.read_csv(participants_file, sep='\t', dtype=str)["participant_id"])
+
+        with open(participants_file, "a" if should_append else "w") as file:
+            if not should_append:
+                file.write("participant_id\tage\tsex\tgroup\tnotes\toriginal_id\n")
+            for data in participants_data.values():
+                if data[0] not in existing_ids:
+                    file.write("\t".join(data) + "\n")
 
 def file_has_required_columns(file_path, required_columns):
     """Check if a file has the required columns."""
@@ -222,48 +425,72 @@ def main():
     bidsdir_folder = os.path.join(bidsfolder, "BIDSDIR")
     sourcedata_dir = os.path.join(bidsdir_folder, "sourcedata")
     raw_dicom_folder = os.path.join(bidsfolder, "Inbox")
-    anon_dicom_folder = os.path.join(bidsfolder, ".temp_anondir")
+    # Each shard gets its own temporary folder so runs sharing this folder do not clean up each other's files
+    anon_dicom_folder = os.path.join(bidsfolder, ".temp_anondir" + shard_suffix(args.shard))
     dcm2bids_config = "dcm2bids_config.json"
 
     # BIDS directory setup
-    if not os.path.exists(bidsdir_folder):
-        print("Creating BIDS directory structure.")
-        scaffold_cmd = ["dcm2bids_scaffold", "-o", bidsdir_folder]
-        subprocess.run(scaffold_cmd)
-    else:
-        print(f"BIDS directory structure already exists at {bidsdir_folder}.")
+    with file_lock(bids_lock_path(bidsdir_folder)):
+        if not os.path.exists(bidsdir_folder):
+            print("Creating BIDS directory structure.")
+            # dcm2bids_scaffold refuses a non-empty output folder, so its log is written outside
+            # BIDSDIR and moved to the log folder of the run afterwards
+            scaffold_cmd = ["dcm2bids_scaffold", "-o", bidsdir_folder]
+            with tempfile.TemporaryDirectory(prefix=".temp_scaffold_log_", dir=bidsfolder) as scaffold_log_dir:
+                scaffold_result = run_job(Job("dcm2bids_scaffold", scaffold_cmd), scaffold_log_dir)
+                # Logs of the external tools of this run go to BIDSDIR/code/logs/<date>_<time>
+                log_dir = new_log_dir(os.path.join(bidsdir_folder, "code", "logs"), shard_suffix(args.shard))
+                shutil.move(scaffold_result.log_file, log_dir)
+            if scaffold_result.returncode != 0:
+                print(f"dcm2bids_scaffold failed, see {os.path.join(log_dir, os.path.basename(scaffold_result.log_file))}",
+                      file=sys.stderr)
+        else:
+            print(f"BIDS directory structure already exists at {bidsdir_folder}.")
+            log_dir = new_log_dir(os.path.join(bidsdir_folder, "code", "logs"), shard_suffix(args.shard))
 
     os.makedirs(sourcedata_dir, exist_ok=True)
     os.makedirs(anon_dicom_folder, exist_ok=True)
 
-
+    # Per-stage timings and throughput, written to <log_dir>/run_report.json at the end
+    run_report = RunReport(profile=args.profile, argv=sys.argv[1:], shard=args.shard)
 
     # Run participants_data.py script
     if not args.noparticipants:
         print("Populating participants.tsv file.")
-        populate_participants_tsv(os.path.join(bidsfolder, "Inbox"), 
-                                  "ID_correspondence.tsv", 
-                                  os.path.join(bidsfolder, "BIDSDIR"))
+        with run_report.stage("participants") as stats:
+            stats.profiled(populate_participants_tsv)(os.path.join(bidsfolder, "Inbox"), 
+                                                      "ID_correspondence.tsv", 
+                                                      os.path.join(bidsfolder, "BIDSDIR"),
+                                                      args.shard, stats)
 
 
 
     # Anonymization step
     if not args.noanon:
-        process_directory(raw_dicom_folder, anon_dicom_folder, patient_id_map)
+        report = None if args.noverify else VerificationReport()
+        with run_report.stage("anonymize") as stats:
+            process_directory(raw_dicom_folder, anon_dicom_folder, patient_id_map, args.shard, report, stats)
+        if report is not None:
+            report_name = f"anonymization_verification_{datetime.now():%Y%m%d_%H%M%S}{shard_suffix(args.shard)}.tsv"
+            report.write(os.path.join(bidsdir_folder, "code", report_name))
     
     if not args.nosort:
         print("Sorting DICOM files.")
         from dicom_sorting_tool import sort_dicom
-        sort_dicom(anon_dicom_folder, sourcedata_dir)
+        with run_report.stage("sort") as stats:
+            stats.profiled(sort_dicom)(anon_dicom_folder, sourcedata_dir, pack=args.packsourcedata, stats=stats)
 
 
     # dcm2bids step
     if not args.nobids:
-        process_new_sessions(sourcedata_dir, bidsdir_folder, dcm2bids_config)
+        with run_report.stage("dcm2bids", workers=args.jobs) as stats:
+            process_new_sessions(sourcedata_dir, bidsdir_folder, dcm2bids_config, args.shard,
+                                 log_dir, args.jobs, args.timeout, args.retries, stats)
 
     if not args.nocleanup:
         shutil.rmtree(anon_dicom_folder)
 
+    run_report.write(log_dir)
     print("Batch process completed.")
 
 
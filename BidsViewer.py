@@ -59,45 +59,45 @@ def process_subject(subject, sequences, BIDSDIR):
     html_output += "</tr>"
     return html_output
 
-if len(sys.argv) < 2:
-    print("Usage: python script.py <path_to_BIDSDIR>")
-    sys.exit(1)
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python script.py <path_to_BIDSDIR>")
+        sys.exit(1)
 
-BIDSDIR = sys.argv[1]
+    BIDSDIR = sys.argv[1]
 
-if len(sys.argv) > 2:
-    sequences = sys.argv[2:]
-else:
-    sequences = input("Enter sequences separated by space (e.g., t1w t2w flair t1c): ").split()
-
-html_header = "<html><body><table><tr><th>Subject</th>"
-for seq in sequences:
-    html_header += f"<th>{seq}</th>"
-html_header += "</tr>"
-
-subjects = [d for d in os.listdir(BIDSDIR) if os.path.isdir(os.path.join(BIDSDIR, d)) and d.startswith('sub-')]
-with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() - 2) as executor:
-    results = executor.map(lambda sub: process_subject(sub, sequences, BIDSDIR), subjects)
-
-
-
-
-output_file_path = "BidsViewer_output.html"
-
-
-try:
-# Create an empty file or clear the existing file
-    html_output = ""
-    with open(output_file_path, "w") as file:
-        pass
-    # Process data
-    html_output = html_header + "".join(results)
-    html_output += "</table></body></html>"
-
-    # Write the actual content
-    with open(output_file_path, "w") as file:
-        file.write(html_output)
-    print("HTML file generated:", output_file_path)
-except Exception as e:
-    print("Error writing file:", e)
+    if len(sys.argv) > 2:
+        sequences = sys.argv[2:]
+    else:
+        sequences = input("Enter sequences separated by space (e.g., t1w t2w flair t1c): ").split()
 
+    html_header = "<html><body><table><tr><th>Subject</th>"
+    for seq in sequences:
+        html_header += f"<th>{seq}</th>"
+    html_header += "</tr>"
+
+    subjects = [d for d in os.listdir(BIDSDIR) if os.path.isdir(os.path.join(BIDSDIR, d)) and d.startswith('sub-')]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() - 2) as executor:
+        results = executor.map(lambda sub: process_subject(sub, sequences, BIDSDIR), subjects)
+
+    output_file_path = "BidsViewer_output.html"
+
+    try:
+    # Create an empty file or clear the existing file
+        html_output = ""
+        with open(output_file_path, "w") as file:
+            pass
+        # Process data
+        html_output = html_header + "".join(results)
+        html_output += "</table></body></html>"
+
+        # Write the actual content
+        with open(output_file_path, "w") as file:
+            file.write(html_output)
+        print("HTML file generated:", output_file_path)
+    except Exception as e:
+        print("Error writing file:", e)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch Sharding Helpers
+
+Lets several Batch_AddStudy.py runs (e.g. on different machines) share one Inbox and one BIDSDIR.
+Every run is given a shard 'i/N' and only handles the subjects whose new subject ID hashes to shard i.
+Steps that touch shared outputs (BIDS scaffold, session numbers, participants.tsv) are serialised
+with a lock file next to BIDSDIR.
+"""
+
+import os
+import argparse
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+def parse_shard(value):
+    """argparse type for '--shard i/N', with shards numbered 1 to N."""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shard must look like i/N (e.g. 1/4), got '{value}'")
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"Shard index must be between 1 and {count}, got '{value}'")
+    return index, count
+
+
+def shard_of(patient_id, count):
+    # crc32 rather than hash(): it does not change between processes or machines
+    return zlib.crc32(str(patient_id).encode('utf-8')) % count + 1
+
+
+def in_shard(key, shard):
+    """True if the key (see shard_key) belongs to this shard. A shard of None means no sharding."""
+    if shard is None:
+        return True
+    index, count = shard
+    return shard_of(key, count) == index
+
+
+def shard_key(patient_id, subject_map):
+    """
+    The new subject ID of a PatientID, or the PatientID itself if it is not in the mapping. Several
+    PatientIDs can map to one subject, so the shard is decided by the subject: it is the name of the
+    sorted sourcedata folder and must be handled by exactly one shard.
+    """
+    return subject_map.get(patient_id, patient_id)
+
+
+def shard_suffix(shard):
+    return "" if shard is None else f"_shard{shard[0]}of{shard[1]}"
+
+
+def bids_lock_path(bidsdir_folder):
+    bidsdir_folder = bidsdir_folder.rstrip(os.sep)
+    return os.path.join(os.path.dirname(bidsdir_folder), f".{os.path.basename(bidsdir_folder)}.lock")
+
+
+@contextmanager
+def file_lock(lock_path):
+    """Exclusive, blocking lock on lock_path (POSIX record lock, which also works over NFS)."""
+    with open(lock_path, 'a+') as lock_file:
+        if fcntl is not None:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.lockf(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Synthetic Dataset Generator
+
+Builds reproducible, fully synthetic test data for the benchmarks, without network access or real
+patient data:
+
+- Inbox/: unsorted DICOM files for several patients, with single-frame series (one file per slice)
+  and, optionally, large multi-frame series (one file holding every frame). Axial, coronal and
+  sagittal orientations are mixed.
+- ID_correspondence.tsv: the mapping of the synthetic PatientIDs to new subject numbers.
+- BIDSDIR/: a BIDS tree with .nii.gz images and JSON sidecars (3D anatomical runs and a 4D BOLD run)
+  for the BIDS viewer, run count and plane orientation scripts.
+
+Usage:
+    python generate_synthetic_dataset.py --out /path/to/dataset --size small
+    python generate_synthetic_dataset.py --out /path/to/dataset --patients 20 --series 6 --instances 40 --frames 200
+
+The same arguments and --seed always produce the same files.
+"""
+
+import os
+import json
+import argparse
+from collections import namedtuple
+import numpy as np
+import nibabel as nib
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, EnhancedMRImageStorage
+
+DatasetSize = namedtuple('DatasetSize', ['patients', 'series', 'instances', 'multiframe_series', 'frames', 'matrix'])
+
+PRESETS = {
+    'small': DatasetSize(patients=4, series=3, instances=10, multiframe_series=1, frames=20, matrix=64),
+    'medium': DatasetSize(patients=16, series=6, instances=30, multiframe_series=1, frames=100, matrix=128),
+    'large': DatasetSize(patients=40, series=8, instances=60, multiframe_series=2, frames=300, matrix=256),
+}
+
+ORIENTATIONS = {
+    'axial': [1, 0, 0, 0, 1, 0],
+    'coronal': [1, 0, 0, 0, 0, -1],
+    'sagittal': [0, 1, 0, 0, 0, -1],
+}
+SEQUENCES = ['T1', 'T2', 'FLAIR', 'T1c', 'DWI', 'SWI', 'PD', 'ADC']
+UID_ROOT = '1.2.826.0.1.3680043.10.1234.'
+
+
+def synthetic_uid(rng):
+    return UID_ROOT + str(rng.integers(10**12, 10**13))
+
+
+def new_dataset(path, sop_class, sop_instance_uid):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = sop_class
+    meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = FileDataset(path, {}, file_meta=meta, preamble=b'\0' * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = sop_class
+    ds.SOPInstanceUID = sop_instance_uid
+    return ds
+
+
+def fill_common(ds, patient, series_number, description, orientation, study_uid, series_uid):
+    ds.PatientName = f"Synthetic^{patient}"
+    ds.PatientID = patient
+    ds.PatientBirthDate = '19700101'
+    ds.PatientAge = '050Y'
+    ds.PatientSex = 'O'
+    ds.StudyDate = '20240101'
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.SeriesNumber = series_number
+    ds.SeriesDescription = description
+    ds.Modality = 'MR'
+    ds.InstitutionName = 'Synthetic Hospital'
+    ds.StationName = 'SYNTH01'
+    ds.DeviceSerialNumber = '0000'
+    ds.ImageOrientationPatient = ORIENTATIONS[orientation]
+    ds.PixelSpacing = [1, 1]
+    ds.SliceThickness = 1
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+
+
+def write_single_frame_series(series_dir, rng, patient, series_number, description, orientation, study_uid,
+                              instances, matrix):
+    series_uid = synthetic_uid(rng)
+    for instance in range(1, instances + 1):
+        path = os.path.join(series_dir, f"IM{series_number:03d}{instance:04d}")
+        ds = new_dataset(path, MRImageStorage, synthetic_uid(rng))
+        fill_common(ds, patient, series_number, description, orientation, study_uid, series_uid)
+        ds.InstanceNumber = instance
+        ds.Rows = ds.Columns = matrix
+        ds.PixelData = rng.integers(0, 4096, (matrix, matrix), dtype=np.uint16).tobytes()
+        ds.save_as(path, write_like_original=False)
+
+
+def write_multiframe_series(series_dir, rng, patient, series_number, description, orientation, study_uid,
+                            frames, matrix):
+    path = os.path.join(series_dir, f"MF{series_number:03d}.dcm")
+    ds = new_dataset(path, EnhancedMRImageStorage, synthetic_uid(rng))
+    fill_common(ds, patient, series_number, description, orientation, study_uid, synthetic_uid(rng))
+    ds.InstanceNumber = 1
+    ds.NumberOfFrames = frames
+    ds.Rows = ds.Columns = matrix
+    ds.PixelData = rng.integers(0, 4096, (frames, matrix, matrix), dtype=np.uint16).tobytes()
+    ds.save_as(path, write_like_original=False)
+
+
+def generate_inbox(out_dir, size, rng):
+    """Write the unsorted Inbox and ID_correspondence.tsv. Returns the number of DICOM files."""
+    inbox = os.path.join(out_dir, 'Inbox')
+    files = 0
+    id_rows = []
+    for p in range(1, size.patients + 1):
+        patient = str(90000000 + p)
+        id_rows.append(f"{p}\t{patient}\n")
+        study_uid = synthetic_uid(rng)
+        # Unsorted on purpose: every series of a patient goes to an anonymous export folder
+        for s in range(1, size.series + size.multiframe_series + 1):
+            series_dir = os.path.join(inbox, f"export_{p:04d}", f"dir{s:03d}")
+            os.makedirs(series_dir, exist_ok=True)
+            description = SEQUENCES[(s - 1) % len(SEQUENCES)]
+            orientation = list(ORIENTATIONS)[(p + s) % len(ORIENTATIONS)]
+            if s <= size.series:
+                write_single_frame_series(series_dir, rng, patient, s, description, orientation, study_uid,
+                                          size.instances, size.matrix)
+                files += size.instances
+            else:
+                write_multiframe_series(series_dir, rng, patient, s, description + '_MF', orientation, study_uid,
+                                        size.frames, size.matrix)
+                files += 1
+    with open(os.path.join(out_dir, 'ID_correspondence.tsv'), 'w') as file:
+        file.writelines(id_rows)
+    return files
+
+
+def write_nifti(path, data, orientation):
+    nib.save(nib.Nifti1Image(data, np.eye(4)), path + '.nii.gz')
+    with open(path + '.json', 'w') as file:
+        json.dump({'ImageOrientationPatientDICOM': ORIENTATIONS[orientation], 'SeriesDescription': 'synthetic'}, file)
+
+
+def generate_bids(out_dir, size, rng):
+    """
+    Write a BIDS tree. ses-01 has two T1w runs (for the 'run-' handling), a T2w and a 4D BOLD run;
+    ses-02 is a T1w-only follow-up, so T1w matches several files per subject and T2w/bold exactly one.
+    """
+    bidsdir = os.path.join(out_dir, 'BIDSDIR')
+    matrix, slices = size.matrix, max(8, size.instances)
+    images = 0
+    for p in range(1, size.patients + 1):
+        subject = f"sub-{p:03d}"
+        for session in ('ses-01', 'ses-02'):
+            anat = os.path.join(bidsdir, subject, session, 'anat')
+            func = os.path.join(bidsdir, subject, session, 'func')
+            os.makedirs(anat, exist_ok=True)
+            if session == 'ses-01':
+                os.makedirs(func, exist_ok=True)
+            orientations = list(ORIENTATIONS)
+            for run in (1, 2):
+                write_nifti(os.path.join(anat, f"{subject}_{session}_run-{run:02d}_T1w"),
+                            rng.random((matrix, matrix, slices), dtype=np.float32), orientations[(p + run) % 3])
+            images += 2
+            if session != 'ses-01':
+                continue
+            write_nifti(os.path.join(anat, f"{subject}_{session}_T2w"),
+                        rng.random((matrix, matrix, slices), dtype=np.float32), orientations[p % 3])
+            write_nifti(os.path.join(func, f"{subject}_{session}_task-rest_bold"),
+                        rng.random((matrix // 2, matrix // 2, slices, 20), dtype=np.float32), 'axial')
+            images += 2
+    return images
+
+
+def generate(out_dir, size, seed=0):
+    """Generate the Inbox, ID table and BIDS tree in out_dir. Returns the number of files written."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    return {'dicom_files': generate_inbox(out_dir, size, rng), 'nifti_images': generate_bids(out_dir, size, rng)}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--out', required=True, help='Output directory')
+    parser.add_argument('--size', choices=PRESETS, default='small', help='Preset dataset size (default: small)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    for field in DatasetSize._fields:
+        parser.add_argument(f'--{field}', type=int, help=f'Override the {field} of the preset')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    overrides = {field: getattr(args, field) for field in DatasetSize._fields if getattr(args, field) is not None}
+    size = PRESETS[args.size]._replace(**overrides)
+    counts = generate(args.out, size, args.seed)
+    print(f"Generated {counts['dicom_files']} DICOM files and {counts['nifti_images']} NIfTI images in {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Benchmark Suite
+
+Measures the throughput and memory use of the main processing steps on synthetic datasets of
+several sizes (see generate_synthetic_dataset.py), so that changes can be compared against stored
+baselines. Runs fully offline.
+
+Stages:
+    anonymize          Batch_AddStudy.process_directory (with pixel data verification) on the Inbox
+    sort               dicom_sorting_tool.sort_dicom on the Inbox
+    bids_viewer        BidsViewer.process_subject for every subject (T1w, T2w, bold)
+    run_count          RunCount_query.count_runs for 'T1w'
+    plane_orientation  Identify_plane_orientation.process_subjects on a copy of the BIDS tree
+
+Every stage runs in a fresh process, so its peak memory (RSS) is measured on its own. With several
+repeats, the median time is reported.
+
+Usage:
+    python run_benchmarks.py --sizes small medium --repeats 3
+    python run_benchmarks.py --sizes small --save-baseline main
+    python run_benchmarks.py --sizes small --compare main --fail-on-regression
+
+Baselines are stored in benchmarks/baselines/<name>.json.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import multiprocessing
+from datetime import datetime
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+BASELINE_DIR = os.path.join(BENCHMARK_DIR, 'baselines')
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from generate_synthetic_dataset import PRESETS, generate
+from run_report import peak_rss_bytes
+
+STAGES = ['anonymize', 'sort', 'bids_viewer', 'run_count', 'plane_orientation']
+VIEWER_SEQUENCES = ['T1w', 'T2w', 'bold']
+
+
+def tree_size(directory):
+    files, size = 0, 0
+    for root, _, names in os.walk(directory):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return files, size
+
+
+def subjects_of(bidsdir):
+    return sorted(d for d in os.listdir(bidsdir) if d.startswith('sub-'))
+
+
+# Each stage takes (dataset_dir, work_dir), does its untimed setup and returns a callable to time,
+# plus the number of files and bytes it reads.
+
+def stage_anonymize(dataset_dir, work_dir):
+    from Batch_AddStudy import process_directory, read_subject_mapping
+    from pixel_verification import VerificationReport
+    inbox = os.path.join(dataset_dir, 'Inbox')
+    mapping = read_subject_mapping(os.path.join(dataset_dir, 'ID_correspondence.tsv'))
+    return (lambda: process_directory(inbox, os.path.join(work_dir, 'anon'), mapping, None, VerificationReport()),
+            *tree_size(inbox))
+
+
+def stage_sort(dataset_dir, work_dir):
+    from dicom_sorting_tool import sort_dicom
+    inbox = os.path.join(dataset_dir, 'Inbox')
+    return lambda: sort_dicom(inbox, os.path.join(work_dir, 'sorted')), *tree_size(inbox)
+
+
+def stage_bids_viewer(dataset_dir, work_dir):
+    from BidsViewer import process_subject
+    bidsdir = os.path.join(dataset_dir, 'BIDSDIR')
+    subjects = subjects_of(bidsdir)
+    return lambda: [process_subject(s, VIEWER_SEQUENCES, bidsdir) for s in subjects], *tree_size(bidsdir)
+
+
+def stage_run_count(dataset_dir, work_dir):
+    from RunCount_query import count_runs
+    bidsdir = os.path.join(dataset_dir, 'BIDSDIR')
+    return lambda: count_runs(bidsdir, 'T1w'), *tree_size(bidsdir)
+
+
+def stage_plane_orientation(dataset_dir, work_dir):
+    from Identify_plane_orientation import process_subjects
+    # The script renames files, so it works on a copy
+    bidsdir = os.path.join(work_dir, 'BIDSDIR')
+    shutil.copytree(os.path.join(dataset_dir, 'BIDSDIR'), bidsdir)
+    return lambda: process_subjects(bidsdir, subjects_of(bidsdir), ['_T1']), *tree_size(bidsdir)
+
+
+def run_stage_in_child(stage, dataset_dir, work_dir, queue):
+    # Silence the progress output of the scripts themselves
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    run, files, size = globals()[f'stage_{stage}'](dataset_dir, work_dir)
+    rss_before = peak_rss_bytes('self')
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    queue.put({'seconds': seconds, 'files': files, 'bytes': size,
+               'peak_rss_bytes': peak_rss_bytes('self'), 'rss_before_bytes': rss_before})
+
+
+def run_stage(stage, dataset_dir):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    with tempfile.TemporaryDirectory(prefix=f'bench_{stage}_') as work_dir:
+        process = context.Process(target=run_stage_in_child, args=(stage, dataset_dir, work_dir, queue))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"Stage {stage} failed with exit code {process.exitcode}")
+        return queue.get()
+
+
+def summarize(runs):
+    seconds = statistics.median(run['seconds'] for run in runs)
+    files, size = runs[0]['files'], runs[0]['bytes']
+    return {
+        'seconds': round(seconds, 4),
+        'seconds_all': [round(run['seconds'], 4) for run in runs],
+        'files': files,
+        'bytes': size,
+        'files_per_s': round(files / seconds, 2),
+        'mb_per_s': round(size / 1e6 / seconds, 2),
+        'peak_rss_mb': round(max(run['peak_rss_bytes'] or 0 for run in runs) / 1e6, 1),
+        'rss_increase_mb': round(max((run['peak_rss_bytes'] or 0) - (run['rss_before_bytes'] or 0) for run in runs) / 1e6, 1),
+    }
+
+
+def run_benchmarks(sizes, stages, repeats, seed, keep_dir=None):
+    results = {}
+    for size_name in sizes:
+        base_dir = keep_dir or tempfile.mkdtemp(prefix='bench_data_')
+        dataset_dir = os.path.join(base_dir, size_name)
+        try:
+            if not os.path.isdir(dataset_dir):
+                print(f"Generating {size_name} dataset in {dataset_dir}")
+                generate(dataset_dir, PRESETS[size_name], seed)
+            for stage in stages:
+                runs = [run_stage(stage, dataset_dir) for _ in range(repeats)]
+                results.setdefault(size_name, {})[stage] = summarize(runs)
+                r = results[size_name][stage]
+                print(f"{size_name:8} {stage:18} {r['seconds']:9.3f} s {r['files_per_s']:10.1f} files/s "
+                      f"{r['mb_per_s']:8.1f} MB/s  peak RSS {r['peak_rss_mb']:8.1f} MB")
+        finally:
+            if keep_dir is None:
+                shutil.rmtree(base_dir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print the change of the median time per stage against a baseline. Returns the regressions."""
+    regressions = []
+    print(f"\nComparison with baseline '{baseline['name']}' ({baseline['created']}):")
+    for size_name, stages in results.items():
+        for stage, result in stages.items():
+            reference = baseline['results'].get(size_name, {}).get(stage)
+            if reference is None:
+                print(f"{size_name:8} {stage:18} no baseline")
+                continue
+            change = (result['seconds'] - reference['seconds']) / reference['seconds']
+            flag = ""
+            if change > threshold:
+                flag = "  REGRESSION"
+                regressions.append((size_name, stage, change))
+            print(f"{size_name:8} {stage:18} {reference['seconds']:9.3f} s -> {result['seconds']:9.3f} s "
+                  f"({change:+.1%}){flag}")
+    return regressions
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', choices=PRESETS, default=['small'], help='Dataset sizes (default: small)')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='Stages to run (default: all)')
+    parser.add_argument('--repeats', type=int, default=3, help='Runs per stage; the median is reported (default: 3)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic datasets (default: 0)')
+    parser.add_argument('--datadir', help='Keep the generated datasets in this folder and reuse them on later runs')
+    parser.add_argument('--output', help='Also write the results to this JSON file')
+    parser.add_argument('--save-baseline', metavar='NAME', help='Store the results as baselines/NAME.json')
+    parser.add_argument('--compare', metavar='NAME', help='Compare the results with baselines/NAME.json')
+    parser.add_argument('--threshold', type=float, default=0.10, help='Slowdown reported as a regression (default: 0.10 = 10%%)')
+    parser.add_argument('--fail-on-regression', action='store_true', help='Exit with code 1 if a regression is found')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    results = run_benchmarks(args.sizes, args.stages, args.repeats, args.seed, args.datadir)
+    report = {
+        'name': args.save_baseline or 'run',
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'host': platform.node(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'seed': args.seed,
+        'repeats': args.repeats,
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        baseline_file = os.path.join(BASELINE_DIR, f"{args.save_baseline}.json")
+        with open(baseline_file, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Baseline saved to {baseline_file}")
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f"{args.compare}.json")) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+DICOM Archive Reader
+
+Helpers to read DICOM files directly from zip and tar(.gz/.bz2/.xz) archives placed in the
+Inbox, so studies do not need to be extracted before they are anonymized and sorted.
+
+Zip archives allow random access, so their members can be read from several worker threads
+at once. Tar archives are read as a single forward stream and their members are handed to
+the workers in archive order.
+"""
+
+import io
+import os
+import threading
+import zipfile
+import tarfile
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+
+ZIP_EXTENSIONS = ('.zip',)
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+ARCHIVE_EXTENSIONS = ZIP_EXTENSIONS + TAR_EXTENSIONS
+
+# Open zip archives kept per worker thread (members are submitted archive by archive)
+ZIP_HANDLES_PER_THREAD = 4
+
+# Tar members read ahead of the workers are held in memory up to this many bytes in total
+MAX_PENDING_BYTES = 512 * 1024 * 1024
+
+# name: member path inside the archive, mtime: POSIX timestamp, read: callable returning the bytes,
+# size: uncompressed size in bytes. For tar archives read() must be called before moving on to the next member.
+ArchiveMember = namedtuple('ArchiveMember', ['name', 'mtime', 'read', 'size'])
+
+_local = threading.local()
+
+
+def is_archive(filename):
+    """Check if a file is a supported zip or tar archive (by extension)."""
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def supports_random_access(archive_path):
+    """Zip members can be read independently and in parallel; tar members cannot."""
+    return archive_path.lower().endswith(ZIP_EXTENSIONS)
+
+
+def archive_parent(archive_path, base_dir):
+    """Relative directory the archive would be extracted into, i.e. the one that contains it."""
+    return os.path.relpath(os.path.dirname(archive_path), base_dir)
+
+
+def member_as_file(archive_path, member_name, data):
+    """Wrap member bytes in a file object whose name points back to the archive (for messages)."""
+    fileobj = io.BytesIO(data)
+    fileobj.name = f"{archive_path}:{member_name}"
+    return fileobj
+
+
+def _safe_member_name(name):
+    """Normalise a member path and reject absolute paths or '..' components, like a safe extract."""
+    name = name.replace('\\', '/')
+    normalized = os.path.normpath(name.lstrip('/'))
+    if os.path.isabs(name) or normalized == '.' or normalized.split(os.sep)[0] == '..':
+        return None
+    return normalized
+
+
+def _zip_handle(archive_path):
+    """
+    One ZipFile handle per thread and archive, so workers do not serialise on a shared handle.
+    Each thread keeps only its ZIP_HANDLES_PER_THREAD most recently used archives open, so the number
+    of open files stays bounded however many archives the Inbox holds.
+    """
+    handles = getattr(_local, 'zip_handles', None)
+    if handles is None:
+        handles = _local.zip_handles = OrderedDict()
+    if archive_path in handles:
+        handles.move_to_end(archive_path)
+    else:
+        while len(handles) >= ZIP_HANDLES_PER_THREAD:
+            handles.popitem(last=False)[1].close()
+        handles[archive_path] = zipfile.ZipFile(archive_path)
+    return handles[archive_path]
+
+
+def read_zip_member(archive_path, member_name):
+    return _zip_handle(archive_path).read(member_name)
+
+
+def _iter_zip_members(archive_path):
+    with zipfile.ZipFile(archive_path) as zf:
+        infos = zf.infolist()
+    for info in infos:
+        if info.is_dir():
+            continue
+        name = _safe_member_name(info.filename)
+        if name is None:
+            print(f"Skipping unsafe archive member {info.filename} in {archive_path}")
+            continue
+        mtime = datetime(*info.date_time).timestamp()
+        yield ArchiveMember(name, mtime,
+                            lambda member=info.filename: read_zip_member(archive_path, member), info.file_size)
+
+
+def _iter_tar_members(archive_path):
+    # Stream mode ('r|*') reads the archive strictly forward and never seeks, which keeps
+    # compressed tarballs to a single decompression pass.
+    with tarfile.open(archive_path, 'r|*') as tf:
+        for member in tf:
+            if not member.isfile():
+                continue
+            name = _safe_member_name(member.name)
+            if name is None:
+                print(f"Skipping unsafe archive member {member.name} in {archive_path}")
+                continue
+            yield ArchiveMember(name, member.mtime,
+                                lambda member=member: tf.extractfile(member).read(), member.size)
+
+
+def iter_archive_members(archive_path):
+    """Yield an ArchiveMember for every regular file in the archive, in archive order."""
+    if supports_random_access(archive_path):
+        return _iter_zip_members(archive_path)
+    return _iter_tar_members(archive_path)
+
+
+class _ByteBudget:
+    """Blocks acquire(n) until n more bytes fit in the budget. One item larger than the budget is let through alone."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, n):
+        with self._condition:
+            self._condition.wait_for(lambda: self.used == 0 or self.used + n <= self.max_bytes)
+            self.used += n
+
+    def release(self, n):
+        with self._condition:
+            self.used -= n
+            self._condition.notify_all()
+
+
+def submit_archive_members(executor, archive_path, fn, *args, max_pending_bytes=MAX_PENDING_BYTES):
+    """
+    Submit fn(archive_path, member_name, member_mtime, data, *args) for every file in the archive.
+
+    Zip members are read inside the worker threads. Tar members are read here, in archive order,
+    and the members waiting for a free worker hold at most max_pending_bytes of memory in total
+    (a single larger member is read on its own), however large the multi-frame files are.
+    """
+    if supports_random_access(archive_path):
+        def read_and_call(member):
+            return fn(archive_path, member.name, member.mtime, member.read(), *args)
+        return [executor.submit(read_and_call, member) for member in iter_archive_members(archive_path)]
+
+    pending = _ByteBudget(max_pending_bytes)
+
+    def call_and_release(name, mtime, data, size):
+        try:
+            return fn(archive_path, name, mtime, data, *args)
+        finally:
+            pending.release(size)
+
+    tasks = []
+    for member in iter_archive_members(archive_path):
+        # Wait for room before reading, so the member being read counts towards the budget too
+        pending.acquire(member.size)
+        data = member.read()
+        tasks.append(executor.submit(call_and_release, member.name, member.mtime, data, member.size))
+    return tasks
+
+
+def write_member(dest_file, data, mtime=None):
+    """Write member bytes to disk, optionally with the archive timestamp as extraction would."""
+    os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+    with open(dest_file, 'wb') as f:
+        f.write(data)
+    if mtime is not None:
+        os.utime(dest_file, (mtime, mtime))
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+DICOM Series Pack Tool
+
+Packed storage for BIDSDIR/sourcedata. Instead of one small file per DICOM instance, every
+%SeriesNumber%_%SeriesDescription% series is stored as a single uncompressed zip file
+(<series>.zip) next to a tab separated index (<series>.index.tsv) with the byte offset and size
+of every instance inside the pack. Instances can be read back with a single seek, and the packs
+remain ordinary zip files that any archive tool can open.
+
+Usage:
+    python dicom_series_pack.py extract --src <pack_or_session_dir> --dest <output_dir>
+    python dicom_series_pack.py pack --src <sourcedata_dir>
+
+'extract' restores the one-file-per-instance layout that dcm2bids expects. 'pack' converts an
+existing unpacked sourcedata tree in place.
+"""
+
+import os
+import argparse
+import shutil
+import struct
+import zipfile
+from collections import OrderedDict
+
+PACK_EXTENSION = '.zip'
+INDEX_EXTENSION = '.index.tsv'
+INDEX_HEADER = "name\toffset\tsize\n"
+
+# Keep at most this many packs open for appending at once while sorting
+MAX_OPEN_PACKS = 32
+
+
+def is_pack(filename):
+    return filename.endswith(PACK_EXTENSION)
+
+
+def index_path_for(pack_path):
+    return pack_path[:-len(PACK_EXTENSION)] + INDEX_EXTENSION
+
+
+def pack_path_for(series_dir):
+    return series_dir.rstrip(os.sep) + PACK_EXTENSION
+
+
+def has_packs(directory):
+    return os.path.isdir(directory) and any(is_pack(f) for f in os.listdir(directory))
+
+
+def build_index(pack_path):
+    """Compute name -> (offset, size) of the raw instance bytes from the zip local headers."""
+    index = OrderedDict()
+    with zipfile.ZipFile(pack_path) as zf, open(pack_path, 'rb') as f:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{pack_path}: member {info.filename} is compressed, not a series pack")
+            f.seek(info.header_offset)
+            local_header = f.read(30)
+            name_len, extra_len = struct.unpack('<HH', local_header[26:30])
+            index[info.filename] = (info.header_offset + 30 + name_len + extra_len, info.file_size)
+    return index
+
+
+def write_index(pack_path, index):
+    index_file = index_path_for(pack_path)
+    temp_file = index_file + '.tmp'
+    with open(temp_file, 'w') as file:
+        file.write(INDEX_HEADER)
+        for name, (offset, size) in index.items():
+            file.write(f"{name}\t{offset}\t{size}\n")
+    # Replacing the index also updates the session folder mtime, which process_new_sessions relies on
+    os.replace(temp_file, index_file)
+
+
+def read_index(pack_path):
+    """Load the offset index of a pack, rebuilding it from the zip if it is missing or stale."""
+    index_file = index_path_for(pack_path)
+    if os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(pack_path):
+        index = OrderedDict()
+        with open(index_file) as file:
+            next(file)
+            for line in file:
+                name, offset, size = line.rstrip('\n').split('\t')
+                index[name] = (int(offset), int(size))
+        return index
+    index = build_index(pack_path)
+    write_index(pack_path, index)
+    return index
+
+
+def read_instance(pack_path, name, index=None):
+    """Return the bytes of one instance of a pack."""
+    offset, size = (index or read_index(pack_path))[name]
+    with open(pack_path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def iter_instances(pack_path):
+    """Yield (name, bytes) for every instance of a pack, in pack order."""
+    index = read_index(pack_path)
+    with open(pack_path, 'rb') as f:
+        for name, (offset, size) in index.items():
+            f.seek(offset)
+            yield name, f.read(size)
+
+
+class PackWriter:
+    """Append instances to series packs, keeping a bounded number of packs open at once."""
+
+    def __init__(self, max_open=MAX_OPEN_PACKS):
+        self.max_open = max_open
+        self.open_packs = OrderedDict()  # pack_path -> (ZipFile, set of member names)
+
+    def _get(self, pack_path):
+        if pack_path in self.open_packs:
+            self.open_packs.move_to_end(pack_path)
+            return self.open_packs[pack_path]
+        if len(self.open_packs) >= self.max_open:
+            self.close_pack(next(iter(self.open_packs)))
+        zf = zipfile.ZipFile(pack_path, 'a', compression=zipfile.ZIP_STORED)
+        self.open_packs[pack_path] = (zf, set(zf.namelist()))
+        return self.open_packs[pack_path]
+
+    def close_pack(self, pack_path):
+        if pack_path not in self.open_packs:
+            return
+        zf, _ = self.open_packs.pop(pack_path)
+        zf.close()
+        write_index(pack_path, build_index(pack_path))
+
+    def add_file(self, series_dir, src_file, name=None):
+        self.add_bytes(series_dir, name or os.path.basename(src_file), src_file=src_file)
+
+    def add_bytes(self, series_dir, name, data=None, src_file=None):
+        pack_path = pack_path_for(series_dir)
+        zf, names = self._get(pack_path)
+        if name in names:
+            print(f"{name} already stored in {pack_path}. Skipping.")
+            return
+        if src_file is not None:
+            zf.write(src_file, name)
+        else:
+            zf.writestr(name, data)
+        names.add(name)
+
+    def close(self):
+        for pack_path in list(self.open_packs):
+            self.close_pack(pack_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def extract_pack(pack_path, dest_dir):
+    """Write the instances of one pack as individual files into dest_dir."""
+    os.makedirs(dest_dir, exist_ok=True)
+    for name, data in iter_instances(pack_path):
+        with open(os.path.join(dest_dir, name), 'wb') as f:
+            f.write(data)
+
+
+def extract_session(session_dir, dest_dir):
+    """
+    Restore the one-file-per-instance layout of a sourcedata session folder into dest_dir.
+    Series stored unpacked are copied as they are.
+    """
+    for entry in sorted(os.listdir(session_dir)):
+        path = os.path.join(session_dir, entry)
+        if is_pack(entry):
+            extract_pack(path, os.path.join(dest_dir, entry[:-len(PACK_EXTENSION)]))
+        elif os.path.isdir(path):
+            shutil.copytree(path, os.path.join(dest_dir, entry), dirs_exist_ok=True)
+
+
+def pack_tree(sourcedata_dir):
+    """Convert every unpacked series folder (<subject>/<studydate>/<series>/) of sourcedata into a pack."""
+    with PackWriter() as writer:
+        for subject in sorted(os.listdir(sourcedata_dir)):
+            subject_dir = os.path.join(sourcedata_dir, subject)
+            if not os.path.isdir(subject_dir):
+                continue
+            for studydate in sorted(os.listdir(subject_dir)):
+                studydate_path = os.path.join(subject_dir, studydate)
+                if not os.path.isdir(studydate_path):
+                    continue
+                for series in sorted(os.listdir(studydate_path)):
+                    series_dir = os.path.join(studydate_path, series)
+                    if not os.path.isdir(series_dir):
+                        continue
+                    print(f"Packing {series_dir}")
+                    for file in sorted(os.listdir(series_dir)):
+                        writer.add_file(series_dir, os.path.join(series_dir, file))
+                    writer.close_pack(pack_path_for(series_dir))
+                    shutil.rmtree(series_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    extract_parser = subparsers.add_parser('extract', help='Extract a series pack or a whole session folder')
+    extract_parser.add_argument('--src', type=str, required=True, help='Path to a <series>.zip pack or a session folder')
+    extract_parser.add_argument('--dest', type=str, required=True, help='Output directory')
+    pack_parser = subparsers.add_parser('pack', help='Pack an existing unpacked sourcedata tree in place')
+    pack_parser.add_argument('--src', type=str, required=True, help='Path to BIDSDIR/sourcedata')
+    args = parser.parse_args()
+
+    if args.command == 'extract':
+        if is_pack(args.src):
+            extract_pack(args.src, os.path.join(args.dest, os.path.basename(args.src)[:-len(PACK_EXTENSION)]))
+        else:
+            extract_session(args.src, args.dest)
+    else:
+        pack_tree(args.src)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,9 @@ import pydicom
 import shutil
 from pathvalidate import sanitize_filepath
 from tqdm import tqdm
+from dicom_archive_reader import is_archive, iter_archive_members, member_as_file, write_member
+from dicom_series_pack import PackWriter
+from run_report import timed
 
 def get_dicom_attribute(dataset, attribute):
     try:
@@ -14,10 +17,24 @@ def get_dicom_attribute(dataset, attribute):
     except AttributeError:
         return 'UNKNOWN'
 
-def copy_dicom_image(src_file, dest_base_dir, pattern):
+def is_known_non_dicom(filename):
     # Skip known non-DICOM file extensions
     non_dicom_extensions = ['.png', '.jpeg', '.jpg', '.gif', '.bmp']
-    if any(src_file.lower().endswith(ext) for ext in non_dicom_extensions):
+    return any(filename.lower().endswith(ext) for ext in non_dicom_extensions)
+
+def get_dest_directory(dataset, dest_base_dir, pattern, create=True):
+    # Replace placeholders in the pattern with actual metadata
+    for attribute in ['PatientID', 'StudyDate', 'SeriesNumber', 'SeriesDescription']:
+        value = get_dicom_attribute(dataset, attribute)
+        pattern = pattern.replace(f'%{attribute}%', value)
+
+    # Sanitize the file path
+    dest_directory = sanitize_filepath(os.path.join(dest_base_dir, pattern), platform='auto')
+    os.makedirs(dest_directory if create else os.path.dirname(dest_directory), exist_ok=True)
+    return dest_directory
+
+def copy_dicom_image(src_file, dest_base_dir, pattern, pack_writer=None):
+    if is_known_non_dicom(src_file):
         return
 
     try:
@@ -25,37 +42,63 @@ def copy_dicom_image(src_file, dest_base_dir, pattern):
     except:
         print(f'Not a DICOM file: {src_file}')
         return
+
+    dest_directory = get_dest_directory(dataset, dest_base_dir, pattern, create=pack_writer is None)
+    if pack_writer is not None:
+        pack_writer.add_file(dest_directory, src_file)
+    else:
+        shutil.copy2(src_file, os.path.join(dest_directory, os.path.basename(src_file)))
+    return os.path.getsize(src_file)
+
+def copy_archive_member(archive_path, member, dest_base_dir, pattern, pack_writer=None):
+    if is_known_non_dicom(member.name):
         return
 
-    # Replace placeholders in the pattern with actual metadata
-    for attribute in ['PatientID', 'StudyDate', 'SeriesNumber', 'SeriesDescription']:
-        value = get_dicom_attribute(dataset, attribute)
-        pattern = pattern.replace(f'%{attribute}%', value)
+    data = member.read()
+    try:
+        dataset = pydicom.dcmread(member_as_file(archive_path, member.name, data))
+    except:
+        print(f'Not a DICOM file: {archive_path}:{member.name}')
+        return
 
-    # Sanitize the file path
-    dest_directory = sanitize_filepath(os.path.join(dest_base_dir, pattern), platform='auto')
-    os.makedirs(dest_directory, exist_ok=True)
-    shutil.copy2(src_file, os.path.join(dest_directory, os.path.basename(src_file)))
+    dest_directory = get_dest_directory(dataset, dest_base_dir, pattern, create=pack_writer is None)
+    if pack_writer is not None:
+        pack_writer.add_bytes(dest_directory, os.path.basename(member.name), data)
+    else:
+        write_member(os.path.join(dest_directory, os.path.basename(member.name)), data, member.mtime)
+    return len(data)
 
-def copy_directory(src_dir, dest_dir, pattern):
+def copy_directory(src_dir, dest_dir, pattern, pack_writer=None, stats=None):
     all_files = [os.path.join(root, file) for root, _, files in os.walk(src_dir) for file in files]
-    for file in tqdm(all_files, desc="Processing", unit="file"):
-        copy_dicom_image(file, dest_dir, pattern)
+    archives = [file for file in all_files if is_archive(file)]
+    for file in tqdm([file for file in all_files if not is_archive(file)], desc="Processing", unit="file"):
+        with timed(stats, file, os.path.getsize(file)) as sizes:
+            sizes['bytes_written'] = copy_dicom_image(file, dest_dir, pattern, pack_writer) or 0
+    for archive in archives:
+        for member in tqdm(iter_archive_members(archive), desc=os.path.basename(archive), unit="file"):
+            with timed(stats, f"{archive}:{member.name}") as sizes:
+                sizes['bytes_written'] = sizes['bytes_read'] = copy_archive_member(archive, member, dest_dir, pattern, pack_writer) or 0
 
 
-def sort_dicom(input_dir, output_dir):
+def sort_dicom(input_dir, output_dir, pack=False, stats=None):
+    """Sort DICOM files by series. With pack=True every series is stored as a single pack (see dicom_series_pack)."""
     pattern = '%PatientID%/%StudyDate%/%SeriesNumber%_%SeriesDescription%'
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    copy_directory(input_dir, output_dir, pattern)
+    if not pack:
+        copy_directory(input_dir, output_dir, pattern, stats=stats)
+        return
+    with PackWriter() as pack_writer:
+        copy_directory(input_dir, output_dir, pattern, pack_writer, stats)
 
 def main():
     parser = argparse.ArgumentParser(description='Copy DICOM files into a structured directory')
-    parser.add_argument('--dicomin', type=str, required=True, help='Path to the directory with unsorted DICOM files')
+    parser.add_argument('--dicomin', type=str, required=True, help='Path to the directory with unsorted DICOM files (zip/tar archives inside it are read directly)')
     parser.add_argument('--dicomout', type=str, required=True, help='Path to the directory where copied DICOM files will be stored')
+    parser.add_argument('--pack', action='store_true', help='Store each series as a single pack with an offset index instead of one file per instance')
     args = parser.parse_args()
 
-    sort_dicom(args.dicomin, args.dicomout)
+    sort_dicom(args.dicomin, args.dicomout, pack=args.pack)
 
 if __name__ == '__main__':
     main()
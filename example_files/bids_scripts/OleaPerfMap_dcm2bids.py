@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Olea Perfusion Maps to BIDS derivatives
+
+Converts the Olea perfusion maps of every patient in the ID correspondence table with dcm2niix into
+BIDSDIR/derivatives/Olea_perfusion/sub-<NEW_ID>/<session>. The DICOM files of each patient are read
+from <input>/<OLD_ID>. Subjects are converted in parallel; the old IDs of a subject mapped from several
+old IDs are converted one after another, since they share an output folder. The output of every dcm2niix
+run is logged to BIDSDIR/derivatives/Olea_perfusion/logs/<date>_<time>/ together with a summary.tsv.
+
+Usage:
+    python OleaPerfMap_dcm2bids.py --bidsdir BIDSDIR --ID_table ID_TABLE --input INPUT_DIR [--session ses-01]
+
+Arguments:
+    --bidsdir  -bd : Path to the BIDSDIR directory
+    --ID_table -id : Path to the ID correspondence file (first column: new ID, second column: old ID)
+    --input    -in : Path to the directory containing one DICOM folder per old ID
+    --session  -se : Session folder applied to ALL converted studies. Introduce full folder names
+                     (so for ses-01 introduce 'ses-01', not just '01')
+"""
+
+import os
+import sys
+import argparse
+
+# tool_runner lives at the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+from tool_runner import Job, run_job_groups, new_log_dir, default_workers
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-bd', '--bidsdir', required=True, help='Path to the BIDSDIR directory')
+    parser.add_argument('-id', '--ID_table', required=True, help='Path to the ID correspondence file')
+    parser.add_argument('-in', '--input', required=True, help='Path to the directory containing DICOM files')
+    parser.add_argument('-se', '--session', default='', help="Session folder applied to ALL converted studies (e.g. 'ses-01')")
+    parser.add_argument('--jobs', type=int, default=default_workers(), help='Number of dcm2niix conversions run in parallel (default: CPU count - 2)')
+    parser.add_argument('--timeout', type=float, default=None, help='Time limit in seconds for each conversion (default: no limit)')
+    parser.add_argument('--retries', type=int, default=0, help='Retry a failed or timed out conversion this many times')
+    return parser.parse_args()
+
+
+def read_id_table(id_table):
+    """Return (new_id, old_id) pairs from the first two tab separated columns, skipping blank lines."""
+    pairs = []
+    with open(id_table) as file:
+        for line in file:
+            columns = line.rstrip('\r\n').split('\t')
+            if len(columns) >= 2 and columns[0]:
+                pairs.append((columns[0], columns[1]))
+    return pairs
+
+
+def build_job_groups(bidsdir, id_pairs, input_dir, session, timeout=None, retries=0):
+    """
+    One group of dcm2niix jobs per output folder. Jobs writing to the same folder (several old IDs mapped
+    to one subject) run one after another, so their '%s_%d' file names do not collide.
+    """
+    groups = {}
+    for new_id, old_id in id_pairs:
+        # Create directory for the new ID in the derivatives/Olea_perfusion folder
+        output_dir = os.path.join(bidsdir, 'derivatives', 'Olea_perfusion', f'sub-{new_id}', session)
+        os.makedirs(output_dir, exist_ok=True)
+        cmd = ['dcm2niix', '-z', 'y', '-f', '%s_%d', '-o', output_dir, os.path.join(input_dir, old_id)]
+        groups.setdefault(output_dir, []).append(Job(f'dcm2niix_sub-{new_id}_{old_id}', cmd, timeout, retries))
+    return list(groups.values())
+
+
+def main():
+    args = parse_arguments()
+    groups = build_job_groups(args.bidsdir, read_id_table(args.ID_table), args.input, args.session,
+                              args.timeout, args.retries)
+    log_dir = new_log_dir(os.path.join(args.bidsdir, 'derivatives', 'Olea_perfusion', 'logs'))
+    results = run_job_groups(groups, log_dir, args.jobs, total=sum(len(group) for group in groups))
+    print("Process completed.")
+    if any(result.returncode != 0 for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Run Report
+
+Timing and throughput instrumentation for batch runs. Every stage of a run (participants, anonymize,
+sort, dcm2bids, ...) records its wall time, the number of files (or jobs) it handled with their bytes
+read and written, the busy time of its workers, its slowest files and the highest memory use (RSS)
+sampled while it ran. The run report is written as JSON together with the peak memory use of the
+whole process and of the external tools it started.
+
+With profiling on, the per-file functions of the worker threads are profiled with cProfile and the
+merged statistics are saved next to the report (profile.pstats, readable with pstats or snakeviz,
+and profile.txt with the top functions by cumulative time).
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import heapq
+import cProfile
+import pstats
+import platform
+import threading
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SLOWEST_FILES = 20
+# Seconds between two samples of the memory use of a stage
+RSS_SAMPLE_INTERVAL = 0.05
+
+
+def peak_rss_bytes(who='self'):
+    """Peak resident set size of this process ('self') or of its finished child processes ('children')."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+
+def current_rss_bytes():
+    """Resident set size of this process right now (Linux only, None elsewhere)."""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class RssSampler:
+    """
+    Samples the current RSS on a background thread between start() and stop(). Unlike ru_maxrss, which is
+    the peak over the whole life of the process, this gives the peak of one stage.
+    """
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.start_rss = None
+        self.start_rss = None
+        self.peak_rss = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        rss = current_rss_bytes()
+        if rss is not None:
+            self.peak_rss = rss if self.peak_rss is None else max(self.peak_rss, rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self.start_rss = current_rss_bytes()
+        if self.start_rss is None:
+            return self
+        self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+        return self
+
+
+class StageStats:
+    """Thread-safe counters of one stage."""
+
+    def __init__(self, name, workers=1, profiled=None):
+        self.name = name
+        self.workers = workers
+        # Wraps per-file functions for profiling; identity when profiling is off
+        self.profiled = profiled or (lambda fn: fn)
+        self.start_rss = None
+        self.peak_rss = None
+        self.files = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.busy_time = 0.0
+        self.wall_time = 0.0
+        self.slowest = []  # min-heap of (seconds, name)
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, bytes_read=0, bytes_written=0):
+        with self._lock:
+            self.files += 1
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+            self.busy_time += seconds
+            if len(self.slowest) < SLOWEST_FILES:
+                heapq.heappush(self.slowest, (seconds, str(name)))
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (seconds, str(name)))
+
+    @contextmanager
+    def timed(self, name, bytes_read=0):
+        """Time one file. The yielded dict can be updated with 'bytes_written' (and 'bytes_read')."""
+        sizes = {'bytes_read': bytes_read, 'bytes_written': 0}
+        start = time.perf_counter()
+        try:
+            yield sizes
+        finally:
+            self.record(name, time.perf_counter() - start, sizes['bytes_read'], sizes['bytes_written'])
+
+    def per_second(self, amount):
+        return round(amount / self.wall_time, 3) if self.wall_time else None
+
+    def as_dict(self):
+        return {
+            'wall_time_s': round(self.wall_time, 3),
+            'files': self.files,
+            'files_per_s': self.per_second(self.files),
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'read_mb_per_s': self.per_second(self.bytes_read / 1e6),
+            'write_mb_per_s': self.per_second(self.bytes_written / 1e6),
+            'workers': self.workers,
+            # Share of the stage wall time the workers spent on files
+            'worker_utilization': self.per_second(self.busy_time / self.workers),
+            # Sampled while the stage ran (None where the current RSS cannot be read)
+            'rss_at_start_bytes': self.start_rss,
+            'peak_rss_bytes': self.peak_rss,
+            'slowest_files': [{'file': name, 'seconds': round(seconds, 4)}
+                              for seconds, name in sorted(self.slowest, reverse=True)],
+        }
+
+
+def timed(stats, name, bytes_read=0):
+    """stats.timed(...) or, when stats is None, a no-op context yielding a throwaway dict."""
+    if stats is None:
+        return nullcontext({})
+    return stats.timed(name, bytes_read)
+
+
+class ThreadProfiler:
+    """cProfile for code running on worker threads: one profiler per thread, merged when saved."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._profiles = []
+        self._lock = threading.Lock()
+
+    def _profile(self):
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            profile = self._local.profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(profile)
+        return profile
+
+    def wrap(self, fn):
+        def profiled(*args, **kwargs):
+            profile = self._profile()
+            profile.enable()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profile.disable()
+        return profiled
+
+    def save(self, pstats_file, text_file, top=50):
+        if not self._profiles:
+            return
+        stats = None
+        for profile in self._profiles:
+            profile.create_stats()
+            stats = pstats.Stats(profile) if stats is None else stats.add(profile)
+        stats.dump_stats(pstats_file)
+        text = io.StringIO()
+        pstats.Stats(pstats_file, stream=text).sort_stats('cumulative').print_stats(top)
+        with open(text_file, 'w') as file:
+            file.write(text.getvalue())
+
+
+class RunReport:
+    """Collects the stages of one run and writes them as a JSON report."""
+
+    def __init__(self, profile=False, **run_info):
+        self.started = datetime.now()
+        self.run_info = run_info
+        self.stages = {}
+        self.profiler = ThreadProfiler() if profile else None
+
+    @contextmanager
+    def stage(self, name, workers=1):
+        stats = self.stages[name] = StageStats(name, workers, self.profiled)
+        print(f"[{name}] started")
+        sampler = RssSampler().start()
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats.wall_time = time.perf_counter() - start
+            sampler.stop()
+            stats.start_rss, stats.peak_rss = sampler.start_rss, sampler.peak_rss
+            print(f"[{name}] {stats.files} files in {stats.wall_time:.1f} s")
+
+    def profiled(self, fn):
+        """fn itself, or fn wrapped for profiling when the report was created with profile=True."""
+        return fn if self.profiler is None else self.profiler.wrap(fn)
+
+    def as_dict(self):
+        return {
+            'started': self.started.isoformat(timespec='seconds'),
+            'finished': datetime.now().isoformat(timespec='seconds'),
+            'host': platform.node(),
+            'cpu_count': os.cpu_count(),
+            'run': self.run_info,
+            'peak_rss_bytes': peak_rss_bytes('self'),
+            'peak_rss_children_bytes': peak_rss_bytes('children'),
+            'stages': {name: stats.as_dict() for name, stats in self.stages.items()},
+        }
+
+    def write(self, report_dir):
+        os.makedirs(report_dir, exist_ok=True)
+        report_file = os.path.join(report_dir, "run_report.json")
+        with open(report_file, 'w') as file:
+            json.dump(self.as_dict(), file, indent=2)
+        print(f"Run report: {report_file}")
+        if self.profiler is not None:
+            self.profiler.save(os.path.join(report_dir, "profile.pstats"), os.path.join(report_dir, "profile.txt"))
+            print(f"Profile: {os.path.join(report_dir, 'profile.txt')}")
+        return report_file
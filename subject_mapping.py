@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Subject Mapping Store
+
+Compiles ID_correspondence.tsv (first column: new subject number, second column: original PatientID)
+into an SQLite file next to it, e.g. ID_correspondence.sqlite. The store is only rebuilt when the TSV
+changes, so very large mapping tables are parsed once instead of at every start. Duplicate and
+conflicting IDs are reported while the store is built.
+
+Usage:
+    python subject_mapping.py --tsv ID_correspondence.tsv
+
+Builds (or refreshes) the store and prints the duplicate/conflict report.
+"""
+
+import os
+import argparse
+import sqlite3
+import threading
+from collections.abc import Mapping
+import pandas as pd
+
+STORE_EXTENSION = '.sqlite'
+SCHEMA_VERSION = '1'
+
+
+def store_path_for(tsv_file):
+    return os.path.splitext(tsv_file)[0] + STORE_EXTENSION
+
+
+def tsv_signature(tsv_file):
+    stat = os.stat(tsv_file)
+    return f"{SCHEMA_VERSION}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def read_mapping_table(tsv_file):
+    """Parse the TSV into a DataFrame with 'original_id' and 'subject' columns (subject as 'sub-NNN')."""
+    df = pd.read_csv(tsv_file, sep=r'\s+', header=None, dtype=str, usecols=[0, 1], names=['number', 'original_id'])
+    df['subject'] = 'sub-' + df['number'].str.zfill(3)
+    return df[['original_id', 'subject']]
+
+
+def report_mapping_problems(df):
+    """
+    Print original IDs listed more than once (duplicates), original IDs mapped to different subjects
+    (conflicts, the last row wins) and subjects shared by several original IDs. Returns the counts.
+    """
+    repeated = df[df.duplicated('original_id', keep=False)]
+    subjects_per_id = repeated.groupby('original_id')['subject'].unique()
+    subject_counts = subjects_per_id.map(len)
+    conflicts = subjects_per_id[subject_counts > 1]
+    duplicates = subjects_per_id[subject_counts == 1]
+
+    unique_pairs = df.drop_duplicates()
+    ids_per_subject = unique_pairs.groupby('subject')['original_id'].nunique()
+    shared_subjects = ids_per_subject[ids_per_subject > 1]
+
+    for original_id in duplicates.index:
+        print(f"Duplicate: PatientID {original_id} is listed more than once in the ID table.")
+    for original_id, subjects in conflicts.items():
+        print(f"Conflict: PatientID {original_id} is mapped to several subjects ({', '.join(subjects)}). Using the last one.")
+    for subject in shared_subjects.index:
+        print(f"Warning: {subject} is mapped from {shared_subjects[subject]} different PatientIDs.")
+    return {'duplicates': len(duplicates), 'conflicts': len(conflicts), 'shared_subjects': len(shared_subjects)}
+
+
+def build_store(tsv_file, store_file):
+    df = read_mapping_table(tsv_file)
+    report_mapping_problems(df)
+    # Same precedence as the former dict comprehension: the last row for an original ID wins
+    df = df.drop_duplicates('original_id', keep='last')
+
+    # Build next to the final file and swap it in, so concurrent runs never read a half written store
+    temp_file = f"{store_file}.{os.getpid()}.tmp"
+    if os.path.exists(temp_file):
+        os.remove(temp_file)
+    with sqlite3.connect(temp_file) as connection:
+        connection.execute("CREATE TABLE mapping (original_id TEXT PRIMARY KEY, subject TEXT NOT NULL) WITHOUT ROWID")
+        connection.executemany("INSERT INTO mapping VALUES (?, ?)", df.itertuples(index=False, name=None))
+        connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        connection.execute("INSERT INTO meta VALUES ('signature', ?)", (tsv_signature(tsv_file),))
+    connection.close()
+    os.replace(temp_file, store_file)
+
+
+def store_is_current(tsv_file, store_file):
+    if not os.path.exists(store_file):
+        return False
+    try:
+        with sqlite3.connect(f"file:{store_file}?mode=ro", uri=True) as connection:
+            row = connection.execute("SELECT value FROM meta WHERE key = 'signature'").fetchone()
+        connection.close()
+    except sqlite3.Error:
+        return False
+    return row is not None and row[0] == tsv_signature(tsv_file)
+
+
+class SubjectMapping(Mapping):
+    """
+    Read-only mapping of original PatientID -> new subject ID ('sub-NNN') backed by the compiled store.
+    Each thread gets its own SQLite connection and lookups are cached, so one instance can be shared by
+    all workers. Pickling only carries the store path.
+    """
+
+    def __init__(self, store_file):
+        self.store_file = store_file
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(f"file:{self.store_file}?mode=ro", uri=True)
+            self._local.connection = connection
+            self._local.cache = {}
+        return connection
+
+    def __getitem__(self, original_id):
+        connection = self._connection()
+        cache = self._local.cache
+        if original_id not in cache:
+            row = connection.execute("SELECT subject FROM mapping WHERE original_id = ?", (original_id,)).fetchone()
+            cache[original_id] = row[0] if row else None
+        if cache[original_id] is None:
+            raise KeyError(original_id)
+        return cache[original_id]
+
+    def __iter__(self):
+        return (row[0] for row in self._connection().execute("SELECT original_id FROM mapping"))
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM mapping").fetchone()[0]
+
+    def __getstate__(self):
+        return {'store_file': self.store_file}
+
+    def __setstate__(self, state):
+        self.__init__(state['store_file'])
+
+
+def load_subject_mapping(tsv_file):
+    """Open the compiled mapping store for tsv_file, (re)building it first if the TSV changed."""
+    store_file = store_path_for(tsv_file)
+    if not store_is_current(tsv_file, store_file):
+        print(f"Compiling {tsv_file} into {store_file}.")
+        build_store(tsv_file, store_file)
+    return SubjectMapping(store_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--tsv', type=str, default='ID_correspondence.tsv', help='Path to the ID correspondence file')
+    args = parser.parse_args()
+
+    store_file = store_path_for(args.tsv)
+    build_store(args.tsv, store_file)
+    print(f"{len(SubjectMapping(store_file))} PatientIDs written to {store_file}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+External Tool Runner
+
+Runs external command line tools (dcm2bids, dcm2bids_scaffold, dcm2niix, ...) as jobs on a bounded
+pool of worker threads. Each job has an optional timeout and number of retries, and its output is
+streamed to its own log file while it runs. A job that times out is killed together with the tools it
+started (e.g. the dcm2niix run of a dcm2bids job). Jobs can have a setup step that runs on the worker
+right before the tool (e.g. extracting its input) and a cleanup step that runs when the job is done.
+Jobs that depend on each other can be put in a group, whose jobs run one after another on one worker.
+When all jobs are done, their exit codes, attempts and wall times are written to summary.tsv in the
+log directory.
+"""
+
+import os
+import re
+import time
+import signal
+import threading
+import subprocess
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# cmd: list of arguments; timeout: seconds per attempt (None for no limit); retries: extra attempts after a failure;
+# retry_cmd: command of the retries if it differs from cmd (e.g. with a flag to overwrite partial output);
+# setup/cleanup: callables run on the worker before the first attempt and after the last one
+Job = namedtuple('Job', ['name', 'cmd', 'timeout', 'retries', 'retry_cmd', 'setup', 'cleanup'],
+                 defaults=(None, 0, None, None, None))
+JobResult = namedtuple('JobResult', ['name', 'cmd', 'returncode', 'attempts', 'wall_time', 'timed_out', 'log_file'])
+
+# Exit code recorded when the tool could not be started at all (e.g. not installed, or the setup failed)
+NOT_STARTED = 127
+
+
+def default_workers():
+    return max(1, multiprocessing.cpu_count() - 2)
+
+
+def new_log_dir(base_dir, suffix=""):
+    """Create and return a timestamped log directory for one run, e.g. <base_dir>/20240101_120000."""
+    log_dir = os.path.join(base_dir, f"{datetime.now():%Y%m%d_%H%M%S}{suffix}")
+    os.makedirs(log_dir, exist_ok=True)
+    return log_dir
+
+
+def log_file_for(job, log_dir):
+    return os.path.join(log_dir, re.sub(r'[^\w.-]+', '_', job.name) + ".log")
+
+
+def start_process(cmd, log):
+    # In its own process group (POSIX), so a timeout can also stop the tools it started
+    if os.name == 'posix':
+        return subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    return subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+
+
+def kill_process(process):
+    """Kill the process and, on POSIX, every process of its group."""
+    if os.name == 'posix':
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    else:
+        process.kill()
+
+
+def run_attempts(job, log):
+    returncode, timed_out, attempts = None, False, 0
+    for attempts in range(1, job.retries + 2):
+        cmd = job.cmd if attempts == 1 or job.retry_cmd is None else job.retry_cmd
+        log.write(f"$ {' '.join(cmd)}  (attempt {attempts})\n")
+        log.flush()
+        try:
+            process = start_process(cmd, log)
+        except OSError as e:
+            # Retrying will not help if the executable cannot be started
+            log.write(f"Could not start {cmd[0]}: {e}\n")
+            return NOT_STARTED, False, attempts
+        try:
+            returncode, timed_out = process.wait(timeout=job.timeout), False
+        except subprocess.TimeoutExpired:
+            kill_process(process)
+            returncode, timed_out = process.wait(), True
+            log.write(f"Timed out after {job.timeout} s\n")
+        log.flush()
+        if returncode == 0:
+            break
+    return returncode, timed_out, attempts
+
+
+def run_job(job, log_dir):
+    """
+    Run one job, retrying on failure or timeout, with stdout and stderr streamed to its log file.
+    The setup of the job runs before the first attempt and its cleanup after the last one.
+    """
+    log_file = log_file_for(job, log_dir)
+    start = time.monotonic()
+    returncode, timed_out, attempts = NOT_STARTED, False, 0
+
+    with open(log_file, 'w') as log:
+        try:
+            try:
+                if job.setup is not None:
+                    job.setup()
+            except Exception as e:
+                log.write(f"Setup of {job.name} failed: {e}\n")
+            else:
+                returncode, timed_out, attempts = run_attempts(job, log)
+        finally:
+            if job.cleanup is not None:
+                job.cleanup()
+
+    return JobResult(job.name, job.cmd, returncode, attempts, time.monotonic() - start, timed_out, log_file)
+
+
+def write_summary(results, summary_file):
+    with open(summary_file, 'w') as file:
+        file.write("job\treturncode\tattempts\twall_time_s\ttimed_out\tlog_file\tcommand\n")
+        for result in results:
+            file.write(f"{result.name}\t{result.returncode}\t{result.attempts}\t{result.wall_time:.1f}\t"
+                       f"{result.timed_out}\t{result.log_file}\t{' '.join(result.cmd)}\n")
+
+
+def run_job_groups(groups, log_dir, max_workers=None, total=None):
+    """
+    Run groups of jobs on at most max_workers threads and return their JobResults, group by group.
+    The jobs of one group run one after another on the same worker; groups run in parallel. Groups are
+    consumed lazily, so a generator can prepare each job right before it runs and clean up after it
+    (e.g. reserve a number that depends on the jobs before it). total is only used for the progress output.
+    Progress is printed as jobs finish and a summary.tsv is written to log_dir.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    progress_lock = threading.Lock()
+    done = 0
+
+    def run_group(jobs):
+        nonlocal done
+        results = []
+        for job in jobs:
+            result = run_job(job, log_dir)
+            results.append(result)
+            status = "timed out" if result.timed_out else f"exit {result.returncode}"
+            with progress_lock:
+                done += 1
+                counter = f"{done}/{total}" if total is not None else f"{done}"
+                print(f"[{counter}] {result.name}: {status} in {result.wall_time:.1f} s")
+        return results
+
+    with ThreadPoolExecutor(max_workers=max_workers or default_workers()) as executor:
+        futures = [executor.submit(run_group, group) for group in groups]
+        results = [result for future in futures for result in future.result()]
+
+    write_summary(results, os.path.join(log_dir, "summary.tsv"))
+    failed = [result for result in results if result.returncode != 0]
+    if failed:
+        print(f"{len(failed)} of {len(results)} jobs failed. See {os.path.join(log_dir, 'summary.tsv')}")
+    return results
+
+
+def run_jobs(jobs, log_dir, max_workers=None):
+    """
+    Run jobs on at most max_workers threads and return their JobResults, in the order of jobs.
+    Progress is printed as jobs finish and a summary.tsv is written to log_dir.
+    """
+    return run_job_groups([[job] for job in jobs], log_dir, max_workers, total=len(jobs))